@@ -1,13 +1,27 @@
 import streamlit as st
 import os
+import io
+import logging
+import re
 import asyncio
+import threading
+import time
+import concurrent.futures
+import hashlib
+import pathlib
+import tempfile
+from collections import OrderedDict
 import edge_tts
+import httpx
+from PIL import Image
 from openai import OpenAI
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 # Page Config
 st.set_page_config(page_title="Museum Alive", page_icon="🏛️")
 st.title("🏛️ Museum Alive: Let Artifacts Speak")
@@ -26,28 +40,195 @@ with st.sidebar:
     st.info("ℹ️ **Note:** This is the Cloud version. AI Vision is disabled to ensure fast performance. Please manually enter the artifact name.")
 
 # Initialize DeepSeek Client
-try:
-    client = OpenAI(
+@st.cache_resource
+def get_client(api_key):
+    """DeepSeek client whose pooled HTTP/2 connection survives reruns"""
+    http_client = httpx.Client(
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=8, keepalive_expiry=300),
+        timeout=30.0
+    )
+    return OpenAI(
         api_key=api_key,
-        base_url="https://api.deepseek.com"
+        base_url="https://api.deepseek.com",
+        http_client=http_client
     )
+
+try:
+    client = get_client(api_key)
 except Exception as e:
     st.error(f"Failed to initialize AI client: {e}")
 
 # --- Core Functions ---
 
-async def generate_audio(text, output_file="output.mp3"):
-    """Generate audio using Edge-TTS (Free)"""
+TTS_VOICE = "zh-CN-YunxiNeural"
+# Edge-TTS starts throttling beyond a handful of parallel requests
+TTS_MAX_CONCURRENCY = 4
+TTS_TIMEOUT_SECONDS = 30
+# A sentence keeps any closing quotes, brackets or markdown that follow its terminator
+SENTENCE = re.compile(r"[^。！？]*[。！？]+[”’」』）)*]*")
+# Pieces without a word character have nothing to speak; Edge-TTS raises on them
+SPEAKABLE = re.compile(r"\w")
+TTS_CACHE_DIR = pathlib.Path(".tts_cache")
+TTS_CACHE_DIR.mkdir(exist_ok=True)
+# Matches the story cache; older MP3s are rarely hit again once their story is evicted
+TTS_CACHE_MAX_FILES = 256
+# Temp files this old were left behind by a killed process
+TTS_CACHE_STALE_TMP_SECONDS = 3600
+
+def tts_cache_path(text, voice=TTS_VOICE):
+    """Where the MP3 for this text and voice lives in the on-disk cache"""
+    key = hashlib.sha256(f"{voice}|{text}".encode("utf-8")).hexdigest()[:16]
+    return TTS_CACHE_DIR / f"{key}.mp3"
+
+def read_tts_cache(path):
+    """Return the cached MP3 bytes, or None if the file is missing"""
     try:
-        # Use a high-quality Chinese voice
-        communicate = edge_tts.Communicate(text, "zh-CN-YunxiNeural")
-        await communicate.save(output_file)
-    except Exception as e:
-        st.error(f"Audio generation failed: {e}")
+        audio = path.read_bytes()
+    except FileNotFoundError:
+        return None  # Never written, or pruned by another session
+    try:
+        # Mark as recently used so pruning keeps it
+        path.touch(exist_ok=True)
+    except FileNotFoundError:
+        pass
+    return audio or None
+
+def write_tts_cache(path, audio):
+    """Atomically store an MP3, then prune the cache to its size limit"""
+    # Readers only ever see a fully written file
+    with tempfile.NamedTemporaryFile(dir=TTS_CACHE_DIR, suffix=".tmp", delete=False) as f:
+        f.write(audio)
+    os.replace(f.name, path)
+    prune_tts_cache()
+
+def prune_tts_cache():
+    """Drop the least recently used MP3s past the limit, and stale temp files"""
+    def mtime(p):
+        try:
+            return p.stat().st_mtime
+        except FileNotFoundError:
+            return None
+    files = [(mtime(p), p) for p in TTS_CACHE_DIR.glob("*.mp3")]
+    files = sorted((f for f in files if f[0] is not None), reverse=True)
+    stale = []
+    for p in TTS_CACHE_DIR.glob("*.tmp"):
+        age = mtime(p)
+        if age is not None and time.time() - age > TTS_CACHE_STALE_TMP_SECONDS:
+            stale.append(p)
+    for p in [p for _, p in files[TTS_CACHE_MAX_FILES:]] + stale:
+        p.unlink(missing_ok=True)
+
+def cut_sentences(text):
+    """Split text into its complete sentences and the unfinished tail"""
+    sentences = []
+    end = 0
+    for match in SENTENCE.finditer(text):
+        sentences.append(match.group())
+        end = match.end()
+    return sentences, text[end:]
+
+def speakable(pieces):
+    """Keep only the pieces that contain something to pronounce"""
+    return [p for p in pieces if SPEAKABLE.search(p)]
+
+def split_sentences(text):
+    """Split a whole Chinese story into the sentences to synthesize"""
+    sentences, tail = cut_sentences(text)
+    return speakable(sentences + [tail])
+
+async def synthesize_sentence(sentence, semaphore):
+    """Fetch the MP3 bytes for one sentence"""
+    audio = bytearray()
+    async with semaphore:
+        communicate = edge_tts.Communicate(sentence, TTS_VOICE)
+        async for chunk in communicate.stream():
+            if chunk["type"] == "audio":
+                audio.extend(chunk["data"])
+    return bytes(audio)
 
-def get_artifact_story(artifact_name):
-    """Ask DeepSeek to roleplay based on artifact name"""
-    prompt = f"""
+@st.cache_resource
+def tts_event_loop():
+    """One background event loop per process, reused across reruns"""
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+@st.cache_resource
+def get_tts_limiter():
+    """Process-wide cap on parallel Edge-TTS requests, created on the shared loop"""
+    async def make_semaphore():
+        return asyncio.Semaphore(TTS_MAX_CONCURRENCY)
+    return asyncio.run_coroutine_threadsafe(make_semaphore(), tts_event_loop()).result()
+
+def submit_sentence(sentence):
+    """Start synthesizing one sentence in the background, returning (sentence, future)"""
+    future = asyncio.run_coroutine_threadsafe(
+        synthesize_sentence(sentence, get_tts_limiter()), tts_event_loop()
+    )
+    return sentence, future
+
+def speak_while_streaming(tokens, clips):
+    """Pass story tokens through, sending each finished sentence to TTS right away"""
+    buffer = ""
+    for token in tokens:
+        yield token
+        sentences, buffer = cut_sentences(buffer + token)
+        if sentences and not buffer:
+            # Closing quotes or markdown may still arrive in the next token
+            buffer = sentences.pop()
+        clips.extend(submit_sentence(s) for s in speakable(sentences))
+    clips.extend(submit_sentence(s) for s in split_sentences(buffer))
+
+def collect_audio(clips, output_file):
+    """Join the sentence clips that succeeded, in order; returns (audio, complete)"""
+    if not clips:
+        st.warning("⚠️ The artifact had nothing to say this time. Please try again.")
+        return None, False
+    _, pending = concurrent.futures.wait(
+        [future for _, future in clips], timeout=TTS_TIMEOUT_SECONDS
+    )
+    parts = []
+    failed = 0
+    for sentence, future in clips:
+        if future in pending:
+            future.cancel()
+            logger.warning("TTS timed out for sentence: %r", sentence)
+            failed += 1
+            continue
+        try:
+            parts.append(future.result())
+        except Exception as e:
+            logger.warning("TTS failed for sentence %r: %s", sentence, e)
+            failed += 1
+
+    # MP3 frames concatenate cleanly, so no re-encoding is needed
+    audio = b"".join(parts)
+    if not audio:
+        st.error("Audio generation failed.")
+        return None, False
+    if failed:
+        # Partial audio is played but not cached, so the next click retries
+        st.warning(f"⚠️ {failed} sentence(s) could not be voiced and were skipped.")
+        return audio, False
+    write_tts_cache(output_file, audio)
+    return audio, True
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def preview_image(raw):
+    """Decode an uploaded photo once and shrink it in uint8 PIL space"""
+    image = Image.open(io.BytesIO(raw))
+    # Only convert modes that cannot be resized smoothly; keep PNG alpha intact
+    if image.mode not in ("RGB", "RGBA", "L", "LA"):
+        image = image.convert("RGBA" if "transparency" in image.info else "RGB")
+    image.thumbnail((768, 768), Image.Resampling.BILINEAR)
+    return image
+
+STORY_CACHE_MAX_ENTRIES = 256
+
+# Built once at import; only the artifact name changes per call
+SYSTEM_MESSAGE = {"role": "system", "content": "You are a sentient museum artifact with a distinct personality."}
+USER_PROMPT_TEMPLATE = """
     The user is looking at a museum artifact named: "{artifact_name}".
     
     Please roleplay as this artifact.
@@ -56,26 +237,59 @@ def get_artifact_story(artifact_name):
     3. Keep it engaging, educational, and under 150 words.
     4. Language: Chinese (Mandarin).
     """
-    
+
+@st.cache_resource
+def story_cache():
+    """Finished stories shared across reruns and sessions, least recently used evicted first"""
+    return OrderedDict()
+
+def stream_artifact_story(artifact_name, status):
+    """Ask DeepSeek to roleplay based on artifact name, yielding tokens as they arrive"""
+    cache = story_cache()
+    # Single lookup: another session may evict the entry at any time
+    story = cache.get(artifact_name)
+    if story is not None:
+        try:
+            cache.move_to_end(artifact_name)
+        except KeyError:
+            pass  # Evicted by another session after the lookup
+        yield story
+        return
+
+    prompt = USER_PROMPT_TEMPLATE.format(artifact_name=artifact_name)
+    tokens = []
     try:
         response = client.chat.completions.create(
             model="deepseek-chat",
-            messages=[
-                {"role": "system", "content": "You are a sentient museum artifact with a distinct personality."},
-                {"role": "user", "content": prompt},
-            ],
-            stream=False
+            messages=[SYSTEM_MESSAGE, {"role": "user", "content": prompt}],
+            stream=True
         )
-        return response.choices[0].message.content
+        for chunk in response:
+            token = chunk.choices[0].delta.content if chunk.choices else None
+            if token:
+                tokens.append(token)
+                yield token
     except Exception as e:
-        return f"I am unable to speak right now... (Error: {str(e)})"
+        # Failed or partial stories are shown but never cached or voiced
+        status["failed"] = True
+        yield f"I am unable to speak right now... (Error: {str(e)})"
+        return
+
+    story = "".join(tokens)
+    # An empty (e.g. filtered) completion would otherwise stick for the whole process
+    if story:
+        cache[artifact_name] = story
+        if len(cache) > STORY_CACHE_MAX_ENTRIES:
+            cache.popitem(last=False)
 
 # --- Main UI ---
 
 # 1. Image Upload (Display Only)
 uploaded_file = st.file_uploader("📸 Upload Artifact Photo (Optional)", type=["jpg", "png", "jpeg"])
 if uploaded_file:
-    st.image(uploaded_file, caption="Artifact Preview", use_container_width=True)
+    # Shrink phone photos before Streamlit re-encodes them
+    image = preview_image(uploaded_file.getvalue())
+    st.image(image, caption="Artifact Preview", use_container_width=True)
 
 # 2. Input
 artifact_name = st.text_input("💡 What is this artifact?", placeholder="e.g., Bronze Mask of Sanxingdui / 三星堆青铜面具")
@@ -86,18 +300,39 @@ if artifact_name and st.button("Let it Speak 🗣️"):
         st.error("Please configure your API Key first!")
     else:
         with st.spinner("The artifact is waking up..."):
-            # A. Generate Story
-            story = get_artifact_story(artifact_name)
+            # Story and voice may both be cached already; then there is nothing to speak
+            cached_story = story_cache().get(artifact_name)
+            speak = cached_story is None or not tts_cache_path(cached_story).exists()
             
-            # Display Story
+            # A. Generate & Display Story, voicing each sentence as soon as it is complete
             st.markdown("### 📜 The Artifact Says:")
+            clips = []
+            status = {"failed": False}
+            tokens = stream_artifact_story(artifact_name, status)
             # Use a nice container for the text
-            st.info(story)
+            with st.container(border=True):
+                story = st.write_stream(speak_while_streaming(tokens, clips) if speak else tokens)
             
-            # B. Generate & Play Audio
-            output_file = "artifact_voice.mp3"
-            asyncio.run(generate_audio(story, output_file))
+            # B. Collect & Play Audio
+            audio_bytes, complete = None, False
+            if status["failed"]:
+                # The error text is shown above but never spoken or cached
+                for _, clip in clips:
+                    clip.cancel()
+            else:
+                # Identical stories reuse the audio already on disk
+                output_file = tts_cache_path(story)
+                audio_bytes = read_tts_cache(output_file)
+                if audio_bytes:
+                    complete = True
+                    for _, clip in clips:
+                        clip.cancel()
+                else:
+                    if not clips:
+                        clips = [submit_sentence(s) for s in split_sentences(story)]
+                    audio_bytes, complete = collect_audio(clips, output_file)
             
-            if os.path.exists(output_file):
-                st.audio(output_file)
+            if audio_bytes:
+                st.audio(audio_bytes, format="audio/mp3")
+            if complete:
                 st.success("🎉 Voice generated successfully!")